@@ -1,19 +1,313 @@
 import click
-import os
+import re
 import requests
-import sys
+import shutil
+import socket
+import threading
 import zipfile
-from defusedxml.ElementTree import fromstring
+import zlib
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from defusedxml.ElementTree import fromstring, iterparse
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+# XML namespaces used in META-INF/container.xml and the package document
+CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+OPF_NS = "http://www.idpf.org/2007/opf"
+
+# Element path and tag in Clark notation, so ElementTree does not have to
+# resolve namespace prefixes on every lookup
+ROOTFILE_PATH = "{%s}rootfiles/{%s}rootfile" % (CONTAINER_NS, CONTAINER_NS)
+MANIFEST_ITEM_TAG = "{%s}item" % OPF_NS
+
+# Relative hrefs that can be appended to the base directory as they are. Hrefs
+# with whitespace, control characters or ";" parameters are left to urljoin,
+# which strips or splits them.
+SIMPLE_HREF = re.compile(r"[^/:?#;\x00-\x20]+(?:/[^/:?#;\x00-\x20]+)*")
+DOT_SEGMENT = re.compile(r"(?:^|/)\.\.?(?:/|$)")
+
+# Files in META-INF that are included in the EPUB if the server has them
+OPTIONAL_META_FILES = (
+    "META-INF/encryption.xml",
+    "META-INF/manifest.xml",
+    "META-INF/metadata.xml",
+    "META-INF/rights.xml",
+    "META-INF/signatures.xml",
+)
+
+# Default number of files downloaded concurrently
+MAX_WORKERS = 16
+
+# Size of the chunks streamed from the network into the EPUB
+CHUNK_SIZE = 64 * 1024
+
+# Downloads larger than this are buffered on disk instead of in memory
+SPOOL_MAX_SIZE = 1024 * 1024
+
+# Limits on the decompressed size of a single file and of the whole EPUB, so
+# a malicious or broken server cannot fill up the disk
+MAX_ENTRY_SIZE = 200 * 1024 * 1024
+MAX_TOTAL_SIZE = 2 * 1024 * 1024 * 1024
+
+# Media types that are already compressed, so they are neither gzipped in
+# transfer nor deflated in the EPUB. SVG and TrueType/OpenType fonts are not
+# compressed formats, so they are deflated like other files.
+STORED_MEDIA_TYPE_PREFIXES = ("image/", "font/", "audio/", "video/")
+STORED_MEDIA_TYPES = ("application/octet-stream",)
+DEFLATED_MEDIA_TYPES = ("image/svg+xml", "font/ttf", "font/otf", "font/sfnt")
+
+# Request headers for files that are stored uncompressed
+IDENTITY_HEADERS = {"Accept-Encoding": "identity"}
+
+# Socket options for all connections: urllib3's defaults, which disable Nagle's
+# algorithm, plus TCP keep-alive. The receive buffer is left to the kernel's
+# autotuning.
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+# Fixed timestamp for all entries, so the same book always gives the same EPUB
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+# Raised when a file or the EPUB as a whole exceeds the size limits
+class DownloadTooLargeError(Exception):
+    pass
+
+
+# Running total of the bytes downloaded for an EPUB. The download workers add
+# to it as data arrives, so the limit also holds for files that are downloaded
+# ahead of the one being written.
+class TotalSize:
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.size += size
+            if self.size > self.limit:
+                raise DownloadTooLargeError("EPUB is larger than %d bytes" % self.limit)
+
+
+# Size of the entry that is being written, per thread, so its compressor can
+# be sized to it
+entry_size = threading.local()
+
+
+# Function to create DEFLATE compressors for zipfile. With ISA-L installed it
+# is used for the default level, as it is considerably faster than zlib; ISA-L
+# has its own levels, so explicit zlib levels still go to zlib. The zlib window
+# is shrunk to fit small entries: most of the cost of setting up a compressor
+# is clearing its window, and a window larger than the entry (plus zlib's
+# 262 byte lookahead) cannot improve compression.
+def get_compressor(compress_type, compresslevel=None):
+    if compress_type != zipfile.ZIP_DEFLATED:
+        return zlib_compressor(compress_type, compresslevel)
+    if isal_zlib is not None and compresslevel is None:
+        return isal_zlib.compressobj(
+            isal_zlib.ISAL_DEFAULT_COMPRESSION, isal_zlib.DEFLATED, -15
+        )
+    if compresslevel is None:
+        compresslevel = zlib.Z_DEFAULT_COMPRESSION
+    size = getattr(entry_size, "value", None)
+    wbits = 15 if size is None else max(9, min(15, (size + 261).bit_length()))
+    return zlib.compressobj(compresslevel, zlib.DEFLATED, -wbits)
+
+
+zlib_compressor = zipfile._get_compressor
+zlib_crc32 = zipfile.crc32
+
+# Number of EPUBs being written with get_compressor installed
+zipfile_patch_count = 0
+zipfile_patch_lock = threading.Lock()
+
+
+# Context manager that makes zipfile use get_compressor, and ISA-L for
+# checksums when it is installed, while an EPUB is written
+@contextmanager
+def fast_zipfile():
+    global zipfile_patch_count
+    with zipfile_patch_lock:
+        if zipfile_patch_count == 0:
+            zipfile._get_compressor = get_compressor
+            if isal_zlib is not None:
+                zipfile.crc32 = isal_zlib.crc32
+        zipfile_patch_count += 1
+    try:
+        yield
+    finally:
+        with zipfile_patch_lock:
+            zipfile_patch_count -= 1
+            if zipfile_patch_count == 0:
+                zipfile._get_compressor = zlib_compressor
+                zipfile.crc32 = zlib_crc32
+
+
+# Adapter that sets SOCKET_OPTIONS on direct and proxied connections
+class SocketOptionsAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs["socket_options"] = SOCKET_OPTIONS
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+# Function to create an adapter that reuses connections and retries transient errors.
+# Every worker gets its own keep-alive connection and the pool blocks rather
+# than opening throwaway sockets.
+def make_adapter(pool_maxsize=MAX_WORKERS):
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 502, 503, 504],
+        # Return the last response once retries run out, so callers see an
+        # HTTPError from raise_for_status() rather than a RetryError
+        raise_on_status=False,
+    )
+    return SocketOptionsAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+        max_retries=retries,
+    )
 
 
 # Function to download the content of a file given its URL
-def download_file(session, url):
-    response = session.get(url)
-    response.raise_for_status()
-    return response.content
+def download_file(session, url, total_size=None):
+    with download_to_spool(session, url, total_size=total_size) as spool:
+        return spool.read()
+
+
+# Function to check whether a manifest item is stored without compression
+def is_stored_media_type(media_type):
+    media_type = media_type.lower()
+    if media_type in DEFLATED_MEDIA_TYPES:
+        return False
+    return media_type in STORED_MEDIA_TYPES or media_type.startswith(
+        STORED_MEDIA_TYPE_PREFIXES
+    )
+
+
+# Function to iterate over the decoded body of a response, raising
+# DownloadTooLargeError once it is larger than MAX_ENTRY_SIZE, or once
+# total_size exceeds its limit
+def iter_limited_content(response, total_size=None):
+    # Content-Length only rejects obvious cases early; it can be missing,
+    # repeated or encoded, so the bytes counted below are the real limit
+    try:
+        content_length = int(response.headers.get("Content-Length", ""))
+    except ValueError:
+        content_length = None
+    if content_length is not None and content_length > MAX_ENTRY_SIZE:
+        raise DownloadTooLargeError(
+            "%s is larger than %d bytes" % (response.url, MAX_ENTRY_SIZE)
+        )
+    size = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_ENTRY_SIZE:
+            raise DownloadTooLargeError(
+                "%s is larger than %d bytes" % (response.url, MAX_ENTRY_SIZE)
+            )
+        if total_size is not None:
+            total_size.add(len(chunk))
+        yield chunk
+
+
+# Response hook for cached sessions. requests-cache reads the whole body into
+# memory to store it, so it is read here first, within the size limit. This
+# also releases the connection of 304 responses, which requests-cache discards
+# without reading; with a blocking pool, those would eventually hang the
+# download.
+def read_limited_content(response, *args, **kwargs):
+    try:
+        response._content = b"".join(iter_limited_content(response))
+    except BaseException:
+        response.close()
+        raise
+
+
+# Function to stream a file given its URL into a temporary file, so large
+# files never have to be held in memory as a whole
+def download_to_spool(session, url, headers=None, total_size=None):
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        with session.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            for chunk in iter_limited_content(response, total_size):
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+# Function to create the ZipInfo for an entry in the EPUB
+def make_zip_info(path, compress_type=zipfile.ZIP_DEFLATED):
+    zip_info = zipfile.ZipInfo(path, date_time=ZIP_DATE_TIME)
+    zip_info.compress_type = compress_type
+    zip_info.external_attr = 0o644 << 16
+    return zip_info
+
+
+# Function to copy a downloaded file into the EPUB, compressing it incrementally
+def write_to_zip(epub_zip, path, spool, compress_type=zipfile.ZIP_DEFLATED):
+    zip_info = make_zip_info(path, compress_type)
+    spool.seek(0, 2)
+    size = spool.tell()
+    spool.seek(0)
+    # With the size known up front, zipfile only adds ZIP64 fields if needed
+    zip_info.file_size = size
+    entry_size.value = size
+    try:
+        with spool, epub_zip.open(zip_info, "w") as out:
+            shutil.copyfileobj(spool, out, CHUNK_SIZE)
+    finally:
+        entry_size.value = None
+    return size
+
+
+# Function to write the oldest of the pending manifest downloads to the EPUB
+def write_pending(epub_zip, pending):
+    future, path, compress_type = pending.popleft()
+    write_to_zip(epub_zip, path, future.result(), compress_type)
+
+
+# Function to create a function that resolves hrefs against base like urljoin,
+# but only parses base once. Anything other than a plain relative path is
+# still resolved by urljoin.
+def make_href_joiner(base):
+    split = urlsplit(base)
+    base_dir = split.path[: split.path.rfind("/") + 1]
+
+    def join(href):
+        if SIMPLE_HREF.fullmatch(href) is None or DOT_SEGMENT.search(href):
+            return urljoin(base, href)
+        return urlunsplit((split.scheme, split.netloc, base_dir + href, "", ""))
+
+    return join
 
 
 # Function to parse XML content
@@ -21,57 +315,149 @@ def parse_xml(xml_content):
     return fromstring(xml_content)
 
 
-# Main function to download the EPUB
-def download_epub(base_url, epub_filename, session):
-    namespaces = {
-        "c": "urn:oasis:names:tc:opendocument:xmlns:container",
-        "opf": "http://www.idpf.org/2007/opf",
-        "dc": "http://purl.org/dc/elements/1.1/",
-    }
+# Function to yield the href and media type of each manifest item while the
+# package document is parsed, so downloads can start before parsing finishes.
+# Every element is removed from its parent once it has been parsed, so the
+# document is never held in memory as a whole tree.
+def iter_manifest_items(rootfile_content):
+    parents = []
+    events = iterparse(BytesIO(rootfile_content), events=("start", "end"))
+    for event, element in events:
+        if event == "start":
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag == MANIFEST_ITEM_TAG:
+            yield element.attrib["href"], element.attrib.get("media-type", "")
+        if parents:
+            parents[-1].remove(element)
 
-    optional_meta_files = [
-        "META-INF/encryption.xml",
-        "META-INF/manifest.xml",
-        "META-INF/metadata.xml",
-        "META-INF/rights.xml",
-        "META-INF/signatures.xml",
-    ]
 
-    mimetype = download_file(session, urljoin(base_url, "mimetype"))
+# Function to close the file of a finished download
+def close_download(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
 
-    container_url = urljoin(base_url, "META-INF/container.xml")
-    container_xml_content = download_file(session, container_url)
 
-    container_xml = parse_xml(container_xml_content)
-    rootfile_elements = container_xml.findall("c:rootfiles/c:rootfile", namespaces)
-    rootfile_paths = [r.attrib["full-path"] for r in rootfile_elements]
+# Function to cancel downloads that have not started yet. Downloads that are
+# running or finished have their files closed once they are done.
+def cancel_downloads(futures):
+    for future in futures:
+        if not future.cancel():
+            future.add_done_callback(close_download)
 
-    with zipfile.ZipFile(epub_filename, "w", zipfile.ZIP_DEFLATED) as epub_zip:
-        epub_zip.writestr("mimetype", mimetype, compress_type=zipfile.ZIP_STORED)
 
-        epub_zip.writestr("META-INF/container.xml", container_xml_content)
+# Main function to download the EPUB
+def download_epub(base_url, epub_filename, session, max_workers=MAX_WORKERS):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloads = []
+        total_size = TotalSize(MAX_TOTAL_SIZE)
+
+        def submit(url, headers=None):
+            future = executor.submit(
+                download_to_spool, session, url, headers, total_size
+            )
+            downloads.append(future)
+            return future
+
+        # Without this, leaving the with block on an error would wait for
+        # every queued download to finish before the error is raised
+        try:
+            write_epub(
+                base_url,
+                epub_filename,
+                session,
+                submit,
+                total_size,
+                max_pending=2 * max_workers,
+            )
+        except BaseException:
+            cancel_downloads(downloads)
+            raise
+
+
+# Function to download the files of the EPUB and write them to epub_filename,
+# using submit to download files in the background and counting all downloads
+# against total_size. At most max_pending
+# manifest files are downloaded ahead of the one being written, so finished
+# downloads do not pile up while waiting for a slow one.
+def write_epub(base_url, epub_filename, session, submit, total_size, max_pending):
+    # Most optional META-INF files do not exist, so probe them all at once
+    # instead of waiting for each 404 in turn
+    meta_futures = {
+        submit(urljoin(base_url, meta_file)): meta_file
+        for meta_file in OPTIONAL_META_FILES
+    }
 
-        for meta_file in optional_meta_files:
-            try:
-                content = download_file(session, urljoin(base_url, meta_file))
-                epub_zip.writestr(meta_file, content)
-            except requests.exceptions.HTTPError:
-                pass
+    mimetype = download_file(session, urljoin(base_url, "mimetype"), total_size)
 
-        for rootfile_path in rootfile_paths:
-            rootfile_url = urljoin(base_url, rootfile_path)
-            rootfile_content = download_file(session, rootfile_url)
-            rootfile_xml = parse_xml(rootfile_content)
-            epub_zip.writestr(rootfile_path, rootfile_content)
+    container_url = urljoin(base_url, "META-INF/container.xml")
+    container_xml_content = download_file(session, container_url, total_size)
 
-            manifest = rootfile_xml.findall("opf:manifest/opf:item", namespaces)
+    container_xml = parse_xml(container_xml_content)
+    rootfile_elements = container_xml.findall(ROOTFILE_PATH)
+    rootfile_paths = [r.attrib["full-path"] for r in rootfile_elements]
 
-            for item in tqdm(manifest):
-                href = item.attrib["href"]
-                file_url = urljoin(rootfile_url, href)
-                file_path = urljoin(rootfile_path, href)
-                file_content = download_file(session, file_url)
-                epub_zip.writestr(file_path, file_content)
+    with fast_zipfile():
+        with zipfile.ZipFile(epub_filename, "w", zipfile.ZIP_DEFLATED) as epub_zip:
+            epub_zip.writestr(make_zip_info("mimetype", zipfile.ZIP_STORED), mimetype)
+
+            epub_zip.writestr(
+                make_zip_info("META-INF/container.xml"), container_xml_content
+            )
+
+            # Entries already in the EPUB. Manifests and rootfiles can list the
+            # same file more than once, and it only has to be downloaded once.
+            written_paths = {"mimetype", "META-INF/container.xml"}
+
+            for future, meta_file in meta_futures.items():
+                try:
+                    spool = future.result()
+                except requests.exceptions.HTTPError:
+                    continue
+                write_to_zip(epub_zip, meta_file, spool)
+                written_paths.add(meta_file)
+
+            for rootfile_path in rootfile_paths:
+                if rootfile_path in written_paths:
+                    continue
+                written_paths.add(rootfile_path)
+
+                rootfile_url = urljoin(base_url, rootfile_path)
+                rootfile_content = download_file(session, rootfile_url, total_size)
+                epub_zip.writestr(make_zip_info(rootfile_path), rootfile_content)
+
+                join_url = make_href_joiner(rootfile_url)
+                join_path = make_href_joiner(rootfile_path)
+
+                # ZipFile is not thread-safe, so only write from this thread. Files
+                # are written in manifest order, so the EPUB is reproducible.
+                pending = deque()
+                with tqdm(unit="file") as progress:
+                    for href, media_type in iter_manifest_items(rootfile_content):
+                        file_url = join_url(href)
+                        file_path = join_path(href)
+                        if file_path in written_paths:
+                            continue
+                        written_paths.add(file_path)
+
+                        if is_stored_media_type(media_type):
+                            future = submit(file_url, IDENTITY_HEADERS)
+                            compress_type = zipfile.ZIP_STORED
+                        else:
+                            future = submit(file_url)
+                            compress_type = zipfile.ZIP_DEFLATED
+                        pending.append((future, file_path, compress_type))
+
+                        while len(pending) > max_pending or (
+                            pending and pending[0][0].done()
+                        ):
+                            write_pending(epub_zip, pending)
+                            progress.update()
+
+                    while pending:
+                        write_pending(epub_zip, pending)
+                        progress.update()
 
 
 # Utility function to parse auth in "username:password" format
@@ -87,40 +473,23 @@ def parse_auth(ctx, param, value):
         )
 
 
-# Utility function to parse headers in "key: value" format
-def parse_headers(ctx, param, value):
-    headers = {}
-    for header in value:
-        try:
-            key, val = header.split(":", 1)
-            headers[key.strip()] = val.strip()
-        except ValueError:
-            raise click.BadParameter('Headers must be in "key: value" format.')
-    return headers
+# Utility function to create a callback that parses "key<sep>value" options
+def parse_key_values(sep, message):
+    def parse(ctx, param, value):
+        result = {}
+        for item in value:
+            key, found, val = item.partition(sep)
+            if not found:
+                raise click.BadParameter(message)
+            result[key.strip()] = val.strip()
+        return result
 
-
-# Utility function to parse cookies in "key=value" format
-def parse_cookies(ctx, param, value):
-    cookies = {}
-    for cookie in value:
-        try:
-            key, val = cookie.split("=", 1)
-            cookies[key.strip()] = val.strip()
-        except ValueError:
-            raise click.BadParameter('Cookies must be in "key=value" format.')
-    return cookies
+    return parse
 
 
-# Utility function to parse query parameters in "key=value" format
-def parse_params(ctx, param, value):
-    params = {}
-    for param in value:
-        try:
-            key, val = param.split("=", 1)
-            params[key.strip()] = val.strip()
-        except ValueError:
-            raise click.BadParameter('Parameters must be in "key=value" format.')
-    return params
+parse_headers = parse_key_values(":", 'Headers must be in "key: value" format.')
+parse_cookies = parse_key_values("=", 'Cookies must be in "key=value" format.')
+parse_params = parse_key_values("=", 'Parameters must be in "key=value" format.')
 
 
 @click.command()
@@ -131,6 +500,12 @@ def parse_params(ctx, param, value):
     callback=parse_auth,
     help="Authentication credentials in username:password format.",
 )
+@click.option(
+    "--cache",
+    help="Path to a cache database. Cached files are revalidated with the server "
+    "and only downloaded again if they changed. Files are held in memory while "
+    "they are cached. Requires requests-cache.",
+)
 @click.option("--cert", help="Path to SSL client certificate file (.pem).")
 @click.option(
     "--cookie",
@@ -145,6 +520,14 @@ def parse_params(ctx, param, value):
     callback=parse_headers,
     help="Additional headers in key: value format.",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=MAX_WORKERS,
+    show_default=True,
+    help="Number of files to download concurrently.",
+)
 @click.option("--max-redirects", type=int, help="Maximum number of redirects allowed.")
 @click.option(
     "--no-verify",
@@ -164,16 +547,38 @@ def main(
     base_url,
     output_file,
     auth,
+    cache,
     cert,
     cookie,
     header,
+    jobs,
     max_redirects,
     no_verify,
     param,
     proxy,
     user_agent,
 ):
-    session = requests.Session()
+    if cache:
+        if requests_cache is None:
+            raise click.UsageError(
+                "--cache requires requests-cache, install the cache extra."
+            )
+        session = requests_cache.CachedSession(
+            cache,
+            backend="sqlite",
+            cache_control=True,
+            always_revalidate=True,
+            # Responses without an ETag or Last-Modified cannot be
+            # revalidated, so they must not be reused without asking
+            expire_after=0,
+        )
+        session.hooks["response"].append(read_limited_content)
+    else:
+        session = requests.Session()
+
+    adapter = make_adapter(pool_maxsize=jobs)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
 
     if auth:
         session.auth = auth
@@ -201,7 +606,7 @@ def main(
 
     session.verify = not no_verify
 
-    download_epub(base_url, output_file, session)
+    download_epub(base_url, output_file, session, max_workers=jobs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+CONTAINER_XML = b"""<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+# Function to create the files of an unzipped EPUB with the given number of
+# chapters, keyed by URL path
+def make_book(chapters, prefix="/book/"):
+    items = "".join(
+        '<item id="c%d" href="Text/chapter%d.xhtml" '
+        'media-type="application/xhtml+xml"/>' % (i, i)
+        for i in range(chapters)
+    )
+    opf = (
+        '<?xml version="1.0"?>'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+        "<manifest>%s</manifest><spine/></package>" % items
+    ).encode()
+    files = {
+        "mimetype": b"application/epub+zip",
+        "META-INF/container.xml": CONTAINER_XML,
+        "OEBPS/content.opf": opf,
+    }
+    for i in range(chapters):
+        files["OEBPS/Text/chapter%d.xhtml" % i] = (
+            b"<html><body>%s</body></html>" % (b"chapter %d " % i * 100)
+        )
+    return {prefix + path: body for path, body in files.items()}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requested.append(self.path)
+        time.sleep(server.delays.get(self.path, server.delay))
+        if self.path in server.delays:
+            with server.lock:
+                server.requested_after_delay[self.path] = len(server.requested)
+
+        body = server.files.get(self.path)
+        status = server.statuses.get(self.path, 200 if body is not None else 404)
+        if status != 200:
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if server.validators and self.headers.get("If-None-Match") == etag:
+            with server.lock:
+                server.not_modified.append(self.path)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        if self.path in server.gzipped:
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        if self.path in server.repeat_content_length:
+            self.send_header("Content-Length", str(len(body)))
+        if server.validators:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.files = {}
+    httpd.statuses = {}
+    httpd.gzipped = set()
+    httpd.validators = True
+    httpd.repeat_content_length = set()
+    httpd.requested = []
+    httpd.not_modified = []
+    httpd.delay = 0
+    httpd.delays = {}
+    httpd.requested_after_delay = {}
+    httpd.lock = threading.Lock()
+    httpd.url = "http://127.0.0.1:%d" % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
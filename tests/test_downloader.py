@@ -0,0 +1,334 @@
+import os
+import subprocess
+import sys
+import zipfile
+from tempfile import SpooledTemporaryFile
+from urllib.parse import urljoin
+
+import click
+import pytest
+import requests
+
+from conftest import make_book
+from unzipped_epub_downloader import downloader
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+
+
+def test_download_epub(server, tmp_path):
+    server.files = make_book(5)
+    output = tmp_path / "book.epub"
+
+    downloader.download_epub(server.url + "/book/", output, requests.Session())
+
+    with zipfile.ZipFile(output) as epub:
+        assert epub.namelist()[0] == "mimetype"
+        assert epub.getinfo("mimetype").compress_type == zipfile.ZIP_STORED
+        for path, body in server.files.items():
+            assert epub.read(path[len("/book/") :]) == body
+        for info in epub.infolist():
+            assert info.extra == b""
+            assert info.extract_version < zipfile.ZIP64_VERSION
+
+
+def test_download_epub_is_reproducible(server, tmp_path):
+    server.files = make_book(10)
+    server.delays["/book/OEBPS/Text/chapter0.xhtml"] = 0.2
+    first = tmp_path / "first.epub"
+    second = tmp_path / "second.epub"
+
+    downloader.download_epub(server.url + "/book/", first, requests.Session())
+    downloader.download_epub(server.url + "/book/", second, requests.Session())
+
+    assert first.read_bytes() == second.read_bytes()
+    with zipfile.ZipFile(first) as epub:
+        assert epub.namelist()[3:] == [
+            "OEBPS/Text/chapter%d.xhtml" % i for i in range(10)
+        ]
+
+
+def test_download_epub_limits_downloads_ahead_of_writer(server, tmp_path):
+    server.files = make_book(100)
+    chapter0 = "/book/OEBPS/Text/chapter0.xhtml"
+    server.delays[chapter0] = 0.5
+    output = tmp_path / "book.epub"
+
+    downloader.download_epub(server.url + "/book/", output, requests.Session(), 2)
+
+    # 8 files before the manifest, chapter0 and at most 4 pending after it
+    assert server.requested_after_delay[chapter0] <= 13
+    with zipfile.ZipFile(output) as epub:
+        assert epub.read("OEBPS/Text/chapter0.xhtml") == server.files[chapter0]
+
+
+def test_download_epub_cancels_queued_downloads_on_error(server, tmp_path):
+    server.files = make_book(50)
+    del server.files["/book/OEBPS/Text/chapter0.xhtml"]
+    server.delay = 0.05
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        downloader.download_epub(
+            server.url + "/book/", tmp_path / "book.epub", requests.Session(), 2
+        )
+
+    assert len(server.requested) < 20
+
+
+def test_download_epub_skips_unavailable_meta_files(server, tmp_path):
+    server.files = make_book(1)
+    server.statuses["/book/META-INF/rights.xml"] = 503
+    output = tmp_path / "book.epub"
+    session = requests.Session()
+    session.mount("http://", downloader.make_adapter())
+
+    downloader.download_epub(server.url + "/book/", output, session)
+
+    with zipfile.ZipFile(output) as epub:
+        assert "META-INF/rights.xml" not in epub.namelist()
+    assert server.requested.count("/book/META-INF/rights.xml") == 4
+
+
+def test_download_epub_accepts_repeated_content_length(server, tmp_path):
+    server.files = make_book(1)
+    server.repeat_content_length.add("/book/mimetype")
+    output = tmp_path / "book.epub"
+
+    downloader.download_epub(server.url + "/book/", output, requests.Session())
+
+    with zipfile.ZipFile(output) as epub:
+        assert epub.read("mimetype") == b"application/epub+zip"
+
+
+def test_download_epub_limits_file_size(server, tmp_path, monkeypatch):
+    server.files = make_book(1)
+    monkeypatch.setattr(downloader, "MAX_ENTRY_SIZE", 1000)
+    server.files["/book/OEBPS/Text/chapter0.xhtml"] = b"x" * 1001
+
+    with pytest.raises(downloader.DownloadTooLargeError):
+        downloader.download_epub(
+            server.url + "/book/", tmp_path / "book.epub", requests.Session()
+        )
+
+
+def test_download_epub_limits_decompressed_file_size(server, tmp_path, monkeypatch):
+    server.files = make_book(1)
+    monkeypatch.setattr(downloader, "MAX_ENTRY_SIZE", 1000)
+    server.files["/book/OEBPS/Text/chapter0.xhtml"] = b"0" * 100000
+    server.gzipped.add("/book/OEBPS/Text/chapter0.xhtml")
+
+    with pytest.raises(downloader.DownloadTooLargeError):
+        downloader.download_epub(
+            server.url + "/book/", tmp_path / "book.epub", requests.Session()
+        )
+
+
+def test_download_epub_limits_total_size(server, tmp_path, monkeypatch):
+    server.files = make_book(5)
+    monkeypatch.setattr(downloader, "MAX_TOTAL_SIZE", 3000)
+
+    with pytest.raises(downloader.DownloadTooLargeError):
+        downloader.download_epub(
+            server.url + "/book/", tmp_path / "book.epub", requests.Session()
+        )
+
+
+def test_download_epub_limits_total_size_ahead_of_writer(
+    server, tmp_path, monkeypatch
+):
+    server.files = make_book(200)
+    server.delays["/book/OEBPS/Text/chapter0.xhtml"] = 0.5
+    limit = sum(
+        len(server.files["/book/" + path])
+        for path in ("mimetype", "META-INF/container.xml", "OEBPS/content.opf")
+    )
+    limit += 3000
+    monkeypatch.setattr(downloader, "MAX_TOTAL_SIZE", limit)
+    spooled = []
+
+    class RecordingSpool(SpooledTemporaryFile):
+        def write(self, data):
+            spooled.append(len(data))
+            return super().write(data)
+
+    monkeypatch.setattr(downloader, "SpooledTemporaryFile", RecordingSpool)
+
+    with pytest.raises(downloader.DownloadTooLargeError):
+        downloader.download_epub(
+            server.url + "/book/", tmp_path / "book.epub", requests.Session()
+        )
+
+    assert sum(spooled) <= limit
+
+
+@pytest.mark.parametrize(
+    "base",
+    [
+        "https://example.com/books/1/OEBPS/content.opf",
+        "https://example.com/books/1/OEBPS/content.opf?token=abc#top",
+        "https://example.com",
+        "OEBPS/content.opf",
+        "content.opf",
+    ],
+)
+@pytest.mark.parametrize(
+    "href",
+    [
+        "Text/chapter1.xhtml",
+        "chapter%201.xhtml",
+        "../Images/cover.jpg",
+        "./style.css",
+        "Text/../style.css",
+        "/absolute.xhtml",
+        "https://other.example.com/font.otf",
+        "c:d.xhtml",
+        "chapter.xhtml?query",
+        "chapter.xhtml#fragment",
+        "Text//chapter.xhtml",
+        "Text/chapter;param.xhtml",
+        " Text/chapter.xhtml",
+        "Text/chapter.xhtml ",
+        "Text/chap\tter.xhtml",
+        "",
+    ],
+)
+def test_make_href_joiner_matches_urljoin(base, href):
+    assert downloader.make_href_joiner(base)(href) == urljoin(base, href)
+
+
+def test_parse_key_values():
+    parse = downloader.parse_key_values(":", "Bad header.")
+
+    assert parse(None, None, ("Accept: text/html", " X-Token :a:b ")) == {
+        "Accept": "text/html",
+        "X-Token": "a:b",
+    }
+    assert parse(None, None, ()) == {}
+    with pytest.raises(click.BadParameter, match="Bad header."):
+        parse(None, None, ("no separator",))
+
+
+def test_iter_manifest_items():
+    opf = b"""<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+  <metadata><title>Book</title></metadata>
+  <manifest>
+    <item id="a" href="Text/a.xhtml" media-type="application/xhtml+xml"/>
+    <item id="b" href="Images/b.png" media-type="image/png"/>
+    <item id="c" href="style.css"/>
+  </manifest>
+  <spine><itemref idref="a"/></spine>
+</package>
+"""
+
+    assert list(downloader.iter_manifest_items(opf)) == [
+        ("Text/a.xhtml", "application/xhtml+xml"),
+        ("Images/b.png", "image/png"),
+        ("style.css", ""),
+    ]
+
+
+@pytest.mark.parametrize(
+    "media_type, stored",
+    [
+        ("image/jpeg", True),
+        ("IMAGE/PNG", True),
+        ("font/woff2", True),
+        ("audio/mpeg", True),
+        ("application/octet-stream", True),
+        ("image/svg+xml", False),
+        ("Image/SVG+XML", False),
+        ("font/ttf", False),
+        ("font/otf", False),
+        ("application/xhtml+xml", False),
+        ("text/css", False),
+        ("", False),
+    ],
+)
+def test_is_stored_media_type(media_type, stored):
+    assert downloader.is_stored_media_type(media_type) is stored
+
+
+def test_zipfile_is_only_patched_while_writing(server, tmp_path):
+    server.files = make_book(1)
+    get_compressor = zipfile._get_compressor
+
+    downloader.download_epub(
+        server.url + "/book/", tmp_path / "book.epub", requests.Session()
+    )
+
+    assert zipfile._get_compressor is get_compressor
+    with downloader.fast_zipfile():
+        assert zipfile._get_compressor is downloader.get_compressor
+        with zipfile.ZipFile(tmp_path / "other.zip", "w", compresslevel=9) as other:
+            other.writestr("a.txt", b"abc" * 1000, zipfile.ZIP_DEFLATED)
+    assert zipfile._get_compressor is get_compressor
+    with zipfile.ZipFile(tmp_path / "other.zip") as other:
+        assert other.read("a.txt") == b"abc" * 1000
+
+
+def run_cli(*args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([SRC_DIR, env.get("PYTHONPATH", "")])
+    return subprocess.run(
+        [sys.executable, "-m", "unzipped_epub_downloader.downloader", *args],
+        env=env,
+        capture_output=True,
+        timeout=60,
+    )
+
+
+def test_cache_revalidates_files(server, tmp_path):
+    pytest.importorskip("requests_cache")
+    server.files = make_book(10)
+    output = tmp_path / "book.epub"
+    args = [server.url + "/book/", str(output), "--jobs", "2"]
+    args += ["--cache", str(tmp_path / "cache")]
+
+    first = run_cli(*args)
+    assert first.returncode == 0, first.stderr
+    expected = output.read_bytes()
+    output.unlink()
+
+    assert server.not_modified == []
+
+    second = run_cli(*args)
+    assert second.returncode == 0, second.stderr
+    assert output.read_bytes() == expected
+    assert len(server.not_modified) == len(server.files)
+
+
+def test_cache_redownloads_files_without_validators(server, tmp_path):
+    pytest.importorskip("requests_cache")
+    server.files = make_book(3)
+    server.validators = False
+    chapter0 = "/book/OEBPS/Text/chapter0.xhtml"
+    output = tmp_path / "book.epub"
+    args = [server.url + "/book/", str(output), "--cache", str(tmp_path / "cache")]
+
+    first = run_cli(*args)
+    assert first.returncode == 0, first.stderr
+    server.files[chapter0] = b"<html><body>changed</body></html>"
+    del server.requested[:]
+
+    second = run_cli(*args)
+    assert second.returncode == 0, second.stderr
+    assert chapter0 in server.requested
+    with zipfile.ZipFile(output) as epub:
+        assert epub.read("OEBPS/Text/chapter0.xhtml") == server.files[chapter0]
+
+
+def test_cache_limits_file_size(server, tmp_path, monkeypatch):
+    requests_cache = pytest.importorskip("requests_cache")
+    server.files = make_book(1)
+    monkeypatch.setattr(downloader, "MAX_ENTRY_SIZE", 1000)
+    server.files["/book/OEBPS/Text/chapter0.xhtml"] = b"0" * 100000
+    server.gzipped.add("/book/OEBPS/Text/chapter0.xhtml")
+    session = requests_cache.CachedSession(str(tmp_path / "cache"), backend="sqlite")
+    session.hooks["response"].append(downloader.read_limited_content)
+
+    with pytest.raises(downloader.DownloadTooLargeError):
+        downloader.download_epub(
+            server.url + "/book/", tmp_path / "book.epub", session
+        )
+    chapter_url = server.url + "/book/OEBPS/Text/chapter0.xhtml"
+    assert not session.cache.contains(url=chapter_url)